@@ -3,37 +3,60 @@ WEBDAV based API for Gluster FS storage
 
 @author aevans
 """
+import logging
 import os
-import traceback
-from urllib.parse import urljoin
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 from django.conf import global_settings as settings
-from django.core.cache import cache, caches
-from django.core.files.move import file_move_safe
+from django.core.cache import cache
 from django.core.files.storage import Storage
 from django.core.signals import setting_changed
 from django.utils._os import safe_join
-from django.utils.encoding import filepath_to_uri
 from django.utils.functional import cached_property
 from gluster import gfapi
 
-from storage.webdav import ResumableWebDav
+from storage.webdav import (DEFAULT_CHUNK_SIZE, PATH_CACHE_SIZE, ResumableWebDav, _acquire_buffer,
+                            _choose_chunk_size, _iter_parallel, _new_hasher, _release_buffer)
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes accumulated before a write is issued to the volume.
+WRITE_BUFFER_SIZE = 4 << 20
+
+# Uploads are split into parts of at least this size, one writer per part.
+MIN_UPLOAD_PART_SIZE = 16 << 20
+MAX_UPLOAD_WORKERS = 8
+
+# Upper bound on the bytes queued in one io_uring batch.
+URING_INFLIGHT_BYTES = 64 << 20
 
 
 class GlusterFSConfig(object):
 
     def __init__(self, host, port, volume, proto=u'tcp', log_file=u'/dev/null',\
-                 log_level=7):
+                 log_level=7, mount_point=None):
         self.host = host
         self.port = port
         self.proto = proto
         self.volume = volume
         self.log_file = log_file
         self.log_level = log_level
+        self.mount_point = mount_point
 
 
 class GlusterFSStorage(Storage, ResumableWebDav):
 
+    OS_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
     def __init__(self, fs_config, option=None, location=None, base_url=None, file_permissions_mode=None,
                  directory_permissions_mode=None):
         """
@@ -41,21 +64,24 @@ class GlusterFSStorage(Storage, ResumableWebDav):
 
         :param fs_config:  The file system config
         :type fs_config:  GlusterFSConfig
-        :param option:  File system Options
+        :param option:  File system Options, checksum_algorithm picks the stored digest
         :type option:  dict
         """
         super(GlusterFSStorage, self).__init__()
         if not option:
             option = settings.CUSTOM_STORAGE_OPTIONS
+        self.checksum_algorithm = option.get('checksum_algorithm', self.checksum_algorithm)
         self.__volume = gfapi.Volume(fs_config.host, fs_config.volume, proto=fs_config.proto,\
                               port=fs_config.port, log_file=fs_config.log_file,\
                               log_level=fs_config.log_level)
         if self.__volume.mounted is False:
             self.__volume.mount()
+        self._mount_point = fs_config.mount_point
         self._location = location
         self._base_url = base_url
         self._file_permissions_mode = file_permissions_mode
         self._directory_permissions_mode = directory_permissions_mode
+        self._paths = {}
         setting_changed.connect(self._clear_cached_properties)
 
     def _clear_cached_properties(self, setting, **kwargs):
@@ -63,8 +89,10 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         if setting == 'MEDIA_ROOT':
             self.__dict__.pop('base_location', None)
             self.__dict__.pop('location', None)
+            self._paths.clear()
         elif setting == 'MEDIA_URL':
             self.__dict__.pop('base_url', None)
+            self.__dict__.pop('_base_url_stripped', None)
         elif setting == 'FILE_UPLOAD_PERMISSIONS':
             self.__dict__.pop('file_permissions_mode', None)
         elif setting == 'FILE_UPLOAD_DIRECTORY_PERMISSIONS':
@@ -87,6 +115,13 @@ class GlusterFSStorage(Storage, ResumableWebDav):
             self._base_url += '/'
         return self._value_or_setting(self._base_url, settings.MEDIA_URL)
 
+    @cached_property
+    def _base_url_stripped(self):
+        base_url = self.base_url
+        if base_url and not base_url.endswith('/'):
+            base_url += '/'
+        return base_url
+
     @cached_property
     def file_permissions_mode(self):
         return self._value_or_setting(self._file_permissions_mode, settings.FILE_UPLOAD_PERMISSIONS)
@@ -96,15 +131,21 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         return self._value_or_setting(self._directory_permissions_mode, settings.FILE_UPLOAD_DIRECTORY_PERMISSIONS)
 
     def path(self, name):
-        return safe_join(self.location, name)
+        # Keyed on the location as well, so reassigning it never returns stale paths.
+        key = (self.location, name)
+        full_path = self._paths.get(key)
+        if full_path is None:
+            full_path = safe_join(self.location, name)
+            if len(self._paths) >= PATH_CACHE_SIZE:
+                self._paths.clear()
+            self._paths[key] = full_path
+        return full_path
 
     def url(self, name):
         if self.base_url is None:
             raise ValueError("This file is not accessible via a URL.")
-        url = filepath_to_uri(name)
-        if url is not None:
-            url = url.lstrip('/')
-        return urljoin(self.base_url, url)
+        # Same quoting as filepath_to_uri, joined onto the cached prefix.
+        return self._base_url_stripped + quote(name.replace('\\', '/').lstrip('/'), safe="/~!*()'")
 
     def join_path(self, path_parts):
         """
@@ -116,6 +157,90 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         """
         return os.path.sep.join(path_parts)
 
+    def _try_stat(self, path):
+        """
+        Stat a path on the volume with a single call
+
+        :param path:  The path to check
+        :type path:  str
+        :return:  Whether the path exists and whether it is a directory
+        :rtype:  tuple
+        """
+        try:
+            path_stat = self.__volume.stat(path)
+        except FileNotFoundError:
+            return (False, False)
+        return (True, stat.S_ISDIR(path_stat.st_mode))
+
+    def _copy_to_volume(self, src, full_path):
+        """
+        Copy a local file into a new file on the volume. Large files are
+        split into parts that are written concurrently, each through its
+        own descriptor at a disjoint offset. A single part is hashed as it
+        is written. With several parts another worker computes the checksum
+        alongside the writes, which reads the source a second time.
+
+        :param src:  Path to the local file
+        :type src:  str
+        :param full_path:  Path of the file to create on the volume
+        :type full_path:  str
+        :return:  The hex digest of the file or None without a checksum_algorithm
+        :rtype:  str
+        """
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            fsize = os.fstat(src_fd).st_size
+            parts = max(1, min(MAX_UPLOAD_WORKERS, fsize // MIN_UPLOAD_PART_SIZE))
+            # Create the file up front so an existing name fails before any work.
+            self.__volume.open(full_path, self.OS_OPEN_FLAGS, 0o666).close()
+            if parts > 1:
+                try:
+                    self.__volume.setxattr(full_path, 'trusted.glusterfs.stripe-count', str(parts))
+                except OSError:
+                    # Only a placement hint, and trusted.* needs privileges.
+                    pass
+            part_size = -(-fsize // parts) or 1
+
+            def write_part(offset, hasher=None):
+                end = min(offset + part_size, fsize)
+                fd = self.__volume.open(full_path, os.O_WRONLY)
+                try:
+                    fd.lseek(offset)
+                    while offset < end:
+                        buf = os.pread(src_fd, min(WRITE_BUFFER_SIZE, end - offset), offset)
+                        if not buf:
+                            break
+                        fd.write(buf)
+                        if hasher is not None:
+                            hasher.update(buf)
+                        offset += len(buf)
+                finally:
+                    fd.close()
+
+            if parts == 1:
+                hasher = _new_hasher(self.checksum_algorithm)
+                write_part(0, hasher)
+                return hasher.hexdigest() if hasher is not None else None
+
+            def hash_source():
+                hasher = _new_hasher(self.checksum_algorithm)
+                offset = 0
+                while True:
+                    buf = os.pread(src_fd, WRITE_BUFFER_SIZE, offset)
+                    if not buf:
+                        break
+                    hasher.update(buf)
+                    offset += len(buf)
+                return hasher.hexdigest()
+
+            # Parts complete out of order, so the digest needs its own pass.
+            with ThreadPoolExecutor(max_workers=parts + 1) as executor:
+                digest = executor.submit(hash_source) if self.checksum_algorithm is not None else None
+                list(executor.map(write_part, range(0, fsize, part_size)))
+                return digest.result() if digest is not None else None
+        finally:
+            os.close(src_fd)
+
     def _save(self, name, content):
         """
         Save a file to the gluster fs.
@@ -127,72 +252,84 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :return:  The name of the file
         """
         full_path = self.path(name)
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                if cache.islocked(full_path) is False:
-                    with cache.lock(full_path):
-                        cache.set(full_path, 'storage')
-                    try:
-                        directory = os.path.dirname(full_path)
-
-                        # Create any intermediate directories that do not exist.
-                        if self.__volume.exists(directory) is False:
-                            try:
-                                if self.directory_permissions_mode is not None:
-                                    # os.makedirs applies the global umask, so we reset it,
-                                    # for consistency with file_permissions_mode behavior.
-                                    self.volume.makedirs(directory, self.directory_permissions_mode)
-                                else:
-                                    self.volume.makedirs(directory)
-                            except FileNotFoundError:
-                                # There's a race between os.path.exists() and os.makedirs().
-                                # If os.makedirs() fails with FileNotFoundError, the directory
-                                # was created concurrently.
-                                pass
-                        if not os.path.isdir(directory):
-                            raise IOError("%s exists and is not a directory." % directory)
-
-                        # There's a potential race condition between get_available_name and
-                        # saving the file; it's possible that two threads might return the
-                        # same name, at which point all sorts of fun happens. So we need to
-                        # try to create the file, but if it already exists we have to go back
-                        # to get_available_name() and try again.
-
-                        while True:
-                            try:
-                                # This file has a file path that we can move.
-                                if hasattr(content, 'temporary_file_path'):
-                                    file_move_safe(content.temporary_file_path(), full_path)
-
-                                # This is a normal uploadedfile that we can stream.
-                                else:
-                                    # The current umask value is masked out by os.open!
-                                    fd = self.__volume.open(full_path, self.OS_OPEN_FLAGS, 0o666)
-                                    _file = None
-                                    try:
-                                        for chunk in content.chunks():
-                                            if _file is None:
-                                                _file = fd.dup()
-                                            _file.write(chunk)
-                                    finally:
-                                        if _file is not None:
-                                            _file.close()
-                                        fd.close()
-                            except FileExistsError:
-                                # A new name is needed if the file exists.
-                                name = self.get_available_name(name)
-                                full_path = self.path(name)
+        lock_path = full_path
+        if self.lock(lock_path, 'storage'):
+            try:
+                with self._rwlock(lock_path, 'w'):
+                    directory = os.path.dirname(full_path)
+
+                    # Create any intermediate directories that do not exist.
+                    exists, is_dir = self._try_stat(directory)
+                    if not exists:
+                        try:
+                            if self.directory_permissions_mode is not None:
+                                self.__volume.makedirs(directory, self.directory_permissions_mode)
                             else:
-                                # OK, the file save worked. Break out of the loop.
-                                break
-
-                        if self.file_permissions_mode is not None:
-                            self.__volume.chmod(full_path, self.file_permissions_mode)
-                    finally:
-                        cache.delete(full_path)
-                    # Store filenames with forward slashes, even on Windows.
-                    return (True, name.replace('\\', '/'))
-        return (False, cache.get(full_path))
+                                self.__volume.makedirs(directory)
+                        except FileExistsError:
+                            # There's a race between the stat and makedirs(). If
+                            # makedirs() fails with FileExistsError, the directory
+                            # was created concurrently.
+                            pass
+                    elif not is_dir:
+                        raise IOError("%s exists and is not a directory." % directory)
+
+                    # There's a potential race condition between get_available_name and
+                    # saving the file; it's possible that two threads might return the
+                    # same name, at which point all sorts of fun happens. So we need to
+                    # try to create the file, but if it already exists we have to go back
+                    # to get_available_name() and try again.
+
+                    while True:
+                        try:
+                            # This file has a file path that we can copy from and remove.
+                            if hasattr(content, 'temporary_file_path'):
+                                digest = self._copy_to_volume(content.temporary_file_path(), full_path)
+                                os.unlink(content.temporary_file_path())
+
+                            # This is a normal uploadedfile that we can stream.
+                            else:
+                                # The current umask value is masked out by os.open!
+                                fd = self.__volume.open(full_path, self.OS_OPEN_FLAGS, 0o666)
+                                hasher = _new_hasher(self.checksum_algorithm)
+                                buf = bytearray()
+                                try:
+                                    # Each write is an RPC, so batch chunks into large writes.
+                                    for chunk in content.chunks(chunk_size=DEFAULT_CHUNK_SIZE):
+                                        if isinstance(chunk, str):
+                                            chunk = chunk.encode()
+                                        if hasher is not None:
+                                            hasher.update(chunk)
+                                        buf.extend(chunk)
+                                        if len(buf) >= WRITE_BUFFER_SIZE:
+                                            fd.write(bytes(buf))
+                                            del buf[:]
+                                    if buf:
+                                        fd.write(bytes(buf))
+                                finally:
+                                    fd.close()
+                                digest = hasher.hexdigest() if hasher is not None else None
+                        except FileExistsError:
+                            # A new name is needed if the file exists.
+                            name = self.get_available_name(name)
+                            full_path = self.path(name)
+                        else:
+                            # OK, the file save worked. Break out of the loop.
+                            break
+
+                    if digest is not None:
+                        try:
+                            self.__volume.setxattr(full_path, 'user.{}'.format(self.checksum_algorithm), digest)
+                        except OSError:
+                            # The file is already written, so keep it without the checksum.
+                            logger.warning("Could not store the checksum of %s", full_path, exc_info=True)
+                    if self.file_permissions_mode is not None:
+                        self.__volume.chmod(full_path, self.file_permissions_mode)
+            finally:
+                self.unlock(lock_path, 'storage')
+            # Store filenames with forward slashes, even on Windows.
+            return (True, name.replace('\\', '/'))
+        return (False, cache.get(lock_path))
 
     def delete(self, name, user):
         """
@@ -206,17 +343,15 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :rtype:  boolean
         """
         full_path = self.path(name)
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                if self.is_locked(full_path) is False:
-                    self.lock(full_path, user)
-                    try:
-                        if self.__volume.exists(full_path):
-                            self.__volume.remove(full_path)
-                    finally:
-                        self.unlock(full_path, user)
-                    return True
-        return False
+        with self._user_lock(full_path, user) as held:
+            if not held:
+                return False
+            with self._rwlock(full_path, 'w'):
+                try:
+                    self.__volume.remove(full_path)
+                except FileNotFoundError:
+                    pass
+        return True
 
     def exists(self, name):
         """
@@ -230,17 +365,23 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         full_path = self.path(name)
         return self.__volume.exists(full_path)
 
-    def get_dirs(self, path, files, dirs):
-        files = []
+    def get_dirs(self, path):
+        """
+        Split a directory's entries into directories and files. The entry
+        types come back with the listing, so no per-entry stat is issued.
+
+        :param path:  The directory path
+        :type path:  str
+        :return:  A tuple of directories and files
+        :rtype:  tuple
+        """
         dirs = []
-        entries = self.__volume.listdir(path)
-        if entries:
-            for entry in entries:
-                path = '/'.join([path, entry])
-                if self.__volume.isfile(path):
-                    files.append(entry)
-                elif self.__volume.isdir(path):
-                    dirs.append(entry)
+        files = []
+        for entry, entry_stat in self.__volume.listdir_with_stat(path):
+            if stat.S_ISDIR(entry_stat.st_mode):
+                dirs.append(entry)
+            elif stat.S_ISREG(entry_stat.st_mode):
+                files.append(entry)
         return (dirs, files)
 
     def listdir(self, path):
@@ -266,16 +407,6 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         full_path = self.path(name)
         return self.__volume.getsize(full_path)
 
-    def url(self, name):
-        """
-        Get a path to the file in glusterfs, not an accessible URL
-        :param name:  The name of the file
-        :type: name:  str
-        :return:  The url
-        :rtype:  str
-        """
-        return self.path(name)
-
     def get_accessed_time(self, name):
         """
         Return the last accessed time (as a datetime) of the file specified by
@@ -327,12 +458,10 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         """
         full_path = self.path(name)
         new_path = self.path(new_name)
-        if self.is_locked(full_path):
-            self.lock(full_path, user)
-            try:
-                self.__volume.copy2(full_path, new_path)
-            finally:
-                self.unlock(full_path, user)
+        with self._user_lock(full_path, user) as held:
+            if held:
+                with self._rwlock(full_path, 'w'):
+                    self.__volume.copy2(full_path, new_path)
 
     def append(self, name, content, user):
         """
@@ -347,17 +476,17 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :rtype: boolean
         """
         full_path = self.path(name)
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                if self.is_locked(full_path) is False:
-                    self.lock(full_path, user)
-                    try:
-                        with self.__volume.fopen(full_path, 'a+') as fp:
-                            fp.write(content)
-                    finally:
-                        self.unlock(full_path, user)
-                    return True
-        return False
+        with self._user_lock(full_path, user) as held:
+            if not held:
+                return False
+            with self._rwlock(full_path, 'w'):
+                with self.__volume.fopen(full_path, 'a+') as fp:
+                    if hasattr(content, 'chunks'):
+                        for chunk in content.chunks(chunk_size=DEFAULT_CHUNK_SIZE):
+                            fp.write(chunk)
+                    else:
+                        fp.write(content)
+        return True
 
     def mkcollection(self, name, user):
         """
@@ -366,24 +495,20 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :type name:  str
         :param user:  The user creating the file
         :type user:  str
-        :return: Whether the file was created and any error
+        :return: Whether the file was created and the name of any error
         :rtype:  tuple
         """
         full_path = self.path(name)
         if self.exists(name) is False:
-            try:
-                with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                    with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                        if self.is_locked(full_path) is False:
-                            self.lock(full_path, user)
-                            try:
-                                self.__volume.mknod(full_path)
-                            finally:
-                                self.unlock(full_path, user)
-                return (True, None)
-            except Exception as e:
-                exception = traceback.format_exc()
-                return (False, exception)
+            with self._user_lock(full_path, user) as held:
+                if held:
+                    with self._rwlock(full_path, 'w'):
+                        try:
+                            self.__volume.mknod(full_path)
+                        except OSError as e:
+                            logger.exception("Could not create collection %s", full_path)
+                            return (False, type(e).__name__)
+                    return (True, None)
         return (False, None)
 
     def propfind(self, name):
@@ -395,11 +520,8 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :rtype:  gfapi.api.Stat
         """
         full_path = self.path(name)
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            fd = self.__volume.open(full_path)
-            stat = fd.fstat()
-            fd.close()
-        return stat
+        with self._rwlock(full_path, 'r'):
+            return self.__volume.stat(full_path)
 
     def safe_read(self, name):
         """
@@ -413,7 +535,7 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         full_path = self.path(name)
         content = None
         if self.exists(name):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
+            with self._rwlock(full_path, 'r'):
                 fd = self._volume.open(full_path)
                 try:
                     content = fd.read()
@@ -421,7 +543,35 @@ class GlusterFSStorage(Storage, ResumableWebDav):
                     fd.close()
         return content
 
-    def safe_read_chunk(self, name, offset=0, length=1024):
+    def _read_chunk_unlocked(self, fd, offset, length, fsize, buf=None):
+        """
+        Read a chunk from an open file. The caller holds the reader lock
+        and passes the size it already knows, so nothing is stat'ed here.
+
+        :param fd:  The open file
+        :type fd:  gfapi.File
+        :param offset:  The offset in bytes to start reading from
+        :type offset:  int
+        :param length:  The number of bytes to read
+        :type length:  int
+        :param fsize:  The size of the file
+        :type fsize:  int
+        :param buf:  Optional buffer to read into, a view of it is returned
+        :type buf:  bytearray
+        :return:  The bytes and number of bytes read
+        :rtype: tuple
+        """
+        if offset >= fsize:
+            return (None, 0)
+        length = min(length, fsize - offset)
+        fd.lseek(offset)
+        if buf is None:
+            byte_buffer = fd.read(length)
+            return (byte_buffer, len(byte_buffer))
+        l = fd.readinto(memoryview(buf)[:length])
+        return (memoryview(buf)[:l], l)
+
+    def safe_read_chunk(self, name, offset=0, length=DEFAULT_CHUNK_SIZE, buf=None, fsize=None):
         """
         Safe read a chunk
         :param name:  The name of the file
@@ -430,47 +580,192 @@ class GlusterFSStorage(Storage, ResumableWebDav):
         :type offset:  int
         :param length:  The number of bytes to read
         :type length:  int
+        :param buf:  Optional buffer to read into, a view of it is returned
+        :type buf:  bytearray
+        :param fsize:  The size of the file when already known, skips the stat
+        :type fsize:  int
         :return:  The bytes and number of bytes read
         :rtype: tuple
         """
         full_path = self.path(name)
-        byte_buffer = None
-        l = 0
-        if self.exists(name):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
+        with self._rwlock(full_path, 'r'):
+            try:
                 fd = self.__volume.fopen(full_path, 'r')
+            except FileNotFoundError:
+                return (None, 0)
+            try:
+                if fsize is None:
+                    fsize = fd.fstat().st_size
+                return self._read_chunk_unlocked(fd, offset, length, fsize, buf)
+            finally:
+                fd.close()
+
+    def download(self, name, max_buf_length, checksum=False, reuse_buffer=False):
+        """
+        Create an iterator for downloading from a file (lazy read).
+        This is useful for rtc. The reader lock is taken and the file
+        opened once for the whole download.
+
+        :param name:  The name of the file
+        :type name:  str
+        :param max_buf_length:  Maximum length of the buffer to read
+        :type max_buf_length:  int
+        :param checksum:  Also yield the file digest, set on the last chunk.
+                          An empty file yields one empty chunk carrying it
+        :type checksum:  boolean
+        :param reuse_buffer:  Read every chunk into one pooled buffer and yield
+                              views of it, each only valid until the next chunk
+        :type reuse_buffer:  boolean
+        :return:  next bytes and number of read bytes with the current offset
+        :rtype:  tuple
+        """
+        full_path = self.path(name)
+        if checksum and self.checksum_algorithm is None:
+            raise ValueError("A checksum needs a checksum_algorithm.")
+        hasher = _new_hasher(self.checksum_algorithm) if checksum else None
+        with self._rwlock(full_path, 'r'):
+            fd = self.__volume.fopen(full_path, 'r')
+            try:
+                fsize = fd.fstat().st_size
+                # Size chunks to the file, never above the caller's limit.
+                chunk_size = min(max_buf_length, _choose_chunk_size(fsize))
+                current_offset = 0
+                if fsize == 0 and hasher is not None:
+                    # No chunk is read from an empty file, so send its digest alone.
+                    yield (b'', 0, 0, hasher.hexdigest())
+                buf = _acquire_buffer(chunk_size) if reuse_buffer else None
                 try:
-                    fsize = self.__volume.getsize(full_path)
-                    if offset < fsize:
-                        rlength = fsize - offset
-                        l = length
-                        if rlength < length:
-                            l = rlength
-                        fd.lseek(offset)
-                        byte_buffer = fd.read(l)
+                    while current_offset < fsize:
+                        view, l = self._read_chunk_unlocked(fd, current_offset, chunk_size, fsize, buf)
+                        if l == 0:
+                            break
+                        current_offset += l
+                        if hasher is None:
+                            yield (view, l, current_offset)
+                        else:
+                            # Hash while the chunk is still hot in cache.
+                            hasher.update(view)
+                            digest = hasher.hexdigest() if current_offset >= fsize else None
+                            yield (view, l, current_offset, digest)
                 finally:
+                    if buf is not None:
+                        _release_buffer(buf)
+            finally:
+                fd.close()
+
+    def download_parallel(self, name, max_buf_length, workers=4):
+        """
+        Create an iterator for downloading from a file with chunks read
+        concurrently. Each worker keeps its own descriptor so seeks do not
+        contend, and the reader lock is held once for the whole download.
+
+        :param name:  The name of the file
+        :type name:  str
+        :param max_buf_length:  Maximum length of the buffer to read
+        :type max_buf_length:  int
+        :param workers:  The number of concurrent readers
+        :type workers:  int
+        :return:  next bytes and number of read bytes with the current offset
+        :rtype:  tuple
+        """
+        full_path = self.path(name)
+        local = threading.local()
+        opened = []
+
+        def read_at(span):
+            offset, length = span
+            fd = getattr(local, 'fd', None)
+            if fd is None:
+                fd = local.fd = self.__volume.fopen(full_path, 'r')
+                opened.append(fd)
+            return self._read_chunk_unlocked(fd, offset, length, fsize)[0]
+
+        with self._rwlock(full_path, 'r'):
+            try:
+                fsize = self.__volume.getsize(full_path)
+                spans = ((offset, min(max_buf_length, fsize - offset))
+                         for offset in range(0, fsize, max_buf_length))
+                for (offset, l), buf in _iter_parallel(read_at, spans, workers):
+                    yield (buf, l, offset + l)
+            finally:
+                for fd in opened:
                     fd.close()
-        return (byte_buffer, l)
 
-    def download(self, name, max_buf_length):
+    def download_uring(self, name, max_buf_length, depth=256, reuse_buffer=False):
         """
-        Create an iterator for downloading from a file (lazy read).
-        This is useful for rtc.
+        Create an iterator for downloading through the FUSE mount with
+        io_uring. Up to depth reads are queued and submitted with a single
+        call, then their completions are harvested together. The depth is
+        lowered so a batch never holds more than URING_INFLIGHT_BYTES, and
+        the batch buffers are allocated once and reused. Falls back to
+        download when liburing is missing or no mount point is configured.
 
         :param name:  The name of the file
         :type name:  str
         :param max_buf_length:  Maximum length of the buffer to read
         :type max_buf_length:  int
+        :param depth:  The number of reads submitted per batch
+        :type depth:  int
+        :param reuse_buffer:  Yield views of the batch buffers, each only valid
+                              until the next chunk
+        :type reuse_buffer:  boolean
         :return:  next bytes and number of read bytes with the current offset
         :rtype:  tuple
         """
+        if liburing is None or self._mount_point is None:
+            yield from self.download(name, max_buf_length, reuse_buffer=reuse_buffer)
+            return
+        depth = max(1, min(depth, URING_INFLIGHT_BYTES // max_buf_length))
         full_path = self.path(name)
-        fsize = self.__volume.getsize(full_path)
-        current_offset = 0
-        while current_offset < fsize:
-            buf, l = self.safe_read_chunk(name, current_offset, max_buf_length)
-            current_offset += l
-            yield (buf, l, current_offset)
+        fuse_path = os.path.join(self._mount_point, full_path.lstrip(os.path.sep))
+        with self._rwlock(full_path, 'r'):
+            fd = os.open(fuse_path, os.O_RDONLY)
+            try:
+                ring = liburing.Ring()
+                cqe = liburing.Cqe()
+                liburing.io_uring_queue_init(depth, ring)
+                try:
+                    files = liburing.FileIndex([fd])
+                    liburing.io_uring_register_files(ring, files)
+                    fsize = os.fstat(fd).st_size
+                    # The ring reads into whole bytearrays, so each slot is exactly
+                    # one chunk long and is reused by every batch.
+                    bufs = [bytearray(min(max_buf_length, fsize))
+                            for _ in range(min(depth, -(-fsize // max_buf_length)))]
+                    offset = 0
+                    while offset < fsize:
+                        batch = []
+                        while len(batch) < depth and offset < fsize:
+                            buf = bufs[len(batch)]
+                            sqe = liburing.io_uring_get_sqe(ring)
+                            liburing.io_uring_prep_read(sqe, 0, buf, offset)
+                            liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_FIXED_FILE)
+                            liburing.io_uring_sqe_set_data64(sqe, len(batch))
+                            batch.append((offset, min(max_buf_length, fsize - offset), buf))
+                            offset += max_buf_length
+                        liburing.io_uring_submit_and_wait(ring, len(batch))
+                        lengths = [0] * len(batch)
+                        harvested = 0
+                        while harvested < len(batch):
+                            liburing.io_uring_wait_cqe(ring, cqe)
+                            ready = liburing.io_uring_cq_ready(ring)
+                            for i in range(ready):
+                                lengths[cqe[i].user_data] = liburing.trap_error(cqe[i].res)
+                            liburing.io_uring_cq_advance(ring, ready)
+                            harvested += ready
+                        for (start, length, buf), l in zip(batch, lengths):
+                            view = memoryview(buf)
+                            # FUSE may return short reads, finish those synchronously.
+                            while l < length:
+                                read = os.preadv(fd, [view[l:length]], start + l)
+                                if read == 0:
+                                    break
+                                l += read
+                            yield (view[:l] if reuse_buffer else bytes(view[:l]), l, start + l)
+                finally:
+                    liburing.io_uring_queue_exit(ring)
+            finally:
+                os.close(fd)
 
     def mkdirs(self, name):
         pass
@@ -4,13 +4,89 @@ WEB Dav implementation for local file storage or RAID
 @author aevans
 """
 
+import errno
+import hashlib
+import mmap
 import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 
-from django.core.cache import cache, caches
+from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 
-from storage.webdav import ResumableWebDav
+from storage.webdav import (DEFAULT_CHUNK_SIZE, PATH_CACHE_SIZE, ResumableWebDav, _acquire_buffer,
+                            _choose_chunk_size, _iter_parallel, _new_hasher, _release_buffer)
+
+try:
+    import fasteners
+except ImportError:
+    fasteners = None
+
+
+# Files at least this large are memory mapped by safe_read instead of read.
+MMAP_THRESHOLD = 64 << 20
+
+# Directory holding the interprocess lock files when LOCAL_STORAGE_LOCKS is
+# 'file'. These locks only exclude processes on the same host.
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'storage_locks')
+
+# Paths are hashed onto a fixed set of lock files so the lock directory
+# does not grow with every path touched.
+LOCK_STRIPES = 1024
+
+# One _StripeLock per lock file, shared by every thread in the process.
+_stripe_locks = {}
+_stripe_locks_guard = threading.Lock()
+
+
+def _lock_stripe(fpath):
+    """
+    Map a path onto its lock file stripe
+
+    :param fpath:  The full file path
+    :type fpath:  str
+    :return:  The stripe number
+    :rtype:  int
+    """
+    return int(hashlib.sha1(fpath.encode()).hexdigest()[:8], 16) % LOCK_STRIPES
+
+
+class _StripeLock(object):
+    """
+    The locks guarding one lock file within this process. fcntl locks
+    belong to the whole process and only exclude other processes, so
+    threads are ordered by a thread lock and the file is read locked once,
+    by the first reader, and released by the last.
+    """
+
+    def __init__(self, lock_file):
+        self._thread_lock = fasteners.ReaderWriterLock()
+        self._process_lock = fasteners.InterProcessReaderWriterLock(lock_file)
+        self._readers = 0
+        self._readers_guard = threading.Lock()
+
+    @contextmanager
+    def read_lock(self):
+        with self._thread_lock.read_lock():
+            with self._readers_guard:
+                if self._readers == 0:
+                    self._process_lock.acquire_read_lock()
+                self._readers += 1
+            try:
+                yield
+            finally:
+                with self._readers_guard:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._process_lock.release_read_lock()
+
+    @contextmanager
+    def write_lock(self):
+        with self._thread_lock.write_lock(), self._process_lock.write_lock():
+            yield
 
 
 class LocalFileStorage(FileSystemStorage, ResumableWebDav):
@@ -23,6 +99,51 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
                                         file_permissions_mode,
                                         directory_permissions_mode)
         self.location = location
+        self._paths = {}
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        """Reset setting based property values."""
+        super(LocalFileStorage, self)._clear_cached_properties(setting, **kwargs)
+        if setting == 'MEDIA_ROOT':
+            self._paths.clear()
+
+    def path(self, name):
+        # Keyed on the location as well, so reassigning it never returns stale paths.
+        key = (self.location, name)
+        full_path = self._paths.get(key)
+        if full_path is None:
+            full_path = super(LocalFileStorage, self).path(name)
+            if len(self._paths) >= PATH_CACHE_SIZE:
+                self._paths.clear()
+            self._paths[key] = full_path
+        return full_path
+
+    @contextmanager
+    def _rwlock(self, fpath, mode='r'):
+        """
+        Hold a read or write lock on a path. Uses the cache lock unless the
+        LOCAL_STORAGE_LOCKS setting is 'file', which takes an interprocess
+        lock file instead. Every worker sharing the files must use the same
+        setting, as the two kinds of lock do not exclude each other.
+
+        :param fpath:  The full file path
+        :type fpath:  str
+        :param mode:  'r' to read or 'w' to write
+        :type mode:  str
+        """
+        if getattr(settings, 'LOCAL_STORAGE_LOCKS', 'cache') != 'file':
+            with super(LocalFileStorage, self)._rwlock(fpath, mode):
+                yield
+            return
+        if fasteners is None:
+            raise ImportError("fasteners is required when LOCAL_STORAGE_LOCKS is 'file'.")
+        lock_file = os.path.join(getattr(settings, 'LOCAL_STORAGE_LOCK_DIR', LOCK_DIR), str(_lock_stripe(fpath)))
+        with _stripe_locks_guard:
+            stripe_lock = _stripe_locks.get(lock_file)
+            if stripe_lock is None:
+                stripe_lock = _stripe_locks[lock_file] = _StripeLock(lock_file)
+        with stripe_lock.write_lock() if mode == 'w' else stripe_lock.read_lock():
+            yield
 
     def join_path(self, path_parts):
         """
@@ -34,36 +155,97 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         """
         return os.path.sep.join(path_parts)
 
+    def _fast_copy(self, src, dst):
+        """
+        Copy a file without moving the bytes through userspace. Uses
+        copy_file_range, which can reflink on XFS or Btrfs, and falls
+        back to sendfile when the kernel refuses it.
+
+        :param src:  Path to the source file
+        :type src:  str
+        :param dst:  Path to the destination file
+        :type dst:  str
+        """
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                size = os.fstat(src_fd).st_size
+                copy_file_range = getattr(os, 'copy_file_range', None)
+                offset = 0
+                while offset < size:
+                    if copy_file_range is not None:
+                        try:
+                            sent = copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                        except OSError as e:
+                            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                                raise
+                            copy_file_range = None
+                            continue
+                    else:
+                        sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
     def listdir(self, path):
         """
-        List files in the
-        :param path:
-        :return:
+        List a directory at the given path. Entry types come from the
+        directory listing itself, so regular entries need no extra stat.
+
+        :param path:  The path to list
+        :type path:  str
+        :return:  A tuple of directories and files
+        :rtype:  tuple
         """
-        fpath = os.path.sep.join([self.location, path])
-        return os.listdir(fpath)
+        dirs = []
+        files = []
+        with os.scandir(self.path(path)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+        return (dirs, files)
 
     def save(self, name, content, max_length=None):
         """
         Save new content to the file specified by name. The content should be
-        a proper File object or any python file-like object, ready to be read
-        from the beginning.
+        raw bytes, a proper File object or any python file-like object, ready
+        to be read from the beginning.
+
+        :param name:  The name of the file
+        :type name:  str
+        :param content:  The content to save
+        :type content:  bytes or File
+        :param max_length:  The maximum length of the file name
+        :type max_length:  int
+        :return:  The name the content was saved under
+        :rtype:  str
         """
         # Get the proper name for the file, as it will actually be saved.
         if name is None:
             name = content.name
         full_path = self.path(name)
-        rval = None
-        if not hasattr(content, 'chunks'):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                    name = self.get_available_name(name, max_length=max_length)
-                    if type(content) is not bytes:
-                        contento = File(content, name)
-                        rval = self._save(name, contento)
-                    else:
-                        with open(self.path(name), 'wb') as fp:
-                            fp.write(content)
+        with self._rwlock(full_path, 'w'):
+            name = self.get_available_name(name, max_length=max_length)
+            if type(content) is not bytes:
+                if not hasattr(content, 'chunks'):
+                    content = File(content, name)
+                rval = self._save(name, content)
+            else:
+                with open(self.path(name), 'wb', buffering=DEFAULT_CHUNK_SIZE) as fp:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    view = memoryview(content)
+                    for offset in range(0, len(view), DEFAULT_CHUNK_SIZE):
+                        fp.write(view[offset:offset + DEFAULT_CHUNK_SIZE])
+                # Store filenames with forward slashes, as _save does.
+                rval = name.replace('\\', '/')
         return rval
 
     def move(self, name, new_name):
@@ -77,11 +259,18 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         :rtype:  boolean
         """
         full_path = self.path(name)
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                new_path = self.path(new_name)
+        with self._rwlock(full_path, 'w'):
+            new_path = self.path(new_name)
+            try:
                 os.rename(full_path, new_path)
-                return True
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Different file systems, so copy in the kernel and remove.
+                self._fast_copy(full_path, new_path)
+                shutil.copystat(full_path, new_path)
+                os.unlink(full_path)
+            return True
         return False
 
     def append(self, name, content, user):
@@ -97,21 +286,17 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         :rtype: boolean
         """
         full_path = self.path(name)
-        if self.is_locked(full_path) is False or cache.get(full_path) is not user:
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                    self.lock(full_path, user)
-                    try:
-                        if type(content) is str:
-                            with open(full_path, 'a') as fp:
-                                fp.write(content)
-                        else:
-                            with open(full_path, 'ab') as fp:
-                                fp.write(content)
-                    finally:
-                        self.unlock(full_path, user)
-                    return True
-        return False
+        with self._user_lock(full_path, user) as held:
+            if not held:
+                return False
+            with self._rwlock(full_path, 'w'):
+                if type(content) is str:
+                    with open(full_path, 'a') as fp:
+                        fp.write(content)
+                else:
+                    with open(full_path, 'ab') as fp:
+                        fp.write(content)
+        return True
 
     def mkcollection(self, name, user):
         """
@@ -124,36 +309,32 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         :rtype: boolean
         """
         full_path = self.path(name)
-        if self.is_locked(full_path) is False:
-            if self.exists(name) is False:
-                with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                    self.lock(full_path, user)
-                    try:
-                        fd = os.mknod(full_path)
-                    finally:
-                        self.unlock(full_path, user)
+        if self.exists(name) is False:
+            with self._user_lock(full_path, user) as held:
+                if held:
+                    with self._rwlock(full_path, 'w'):
+                        os.mknod(full_path)
                     return True
         return False
 
     def propfind(self, name):
         """
-        Get file properties
+        Get file properties. Every field comes from a single stat.
         :param name:  The name of the file
         :type name:  str
         :return:  File information
         :rtype:  dict
         """
         full_path = self.path(name)
+        with self._rwlock(full_path, 'r'):
+            fstat = os.stat(full_path)
         finf = {}
-        with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-            with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                finf['modified_time'] = self.get_modified_time(name)
-                finf['accessed_time'] = self.get_accessed_time(name)
-                finf['created_time'] = self.get_created_time(name)
-                finf['valid_name'] = self.get_valid_name(name)
-                finf['path'] = full_path
-                fd = os.open(full_path, os.O_RDONLY)
-                finf['fstat'] = os.fstat(fd)
+        finf['modified_time'] = self._datetime_from_timestamp(fstat.st_mtime)
+        finf['accessed_time'] = self._datetime_from_timestamp(fstat.st_atime)
+        finf['created_time'] = self._datetime_from_timestamp(fstat.st_ctime)
+        finf['valid_name'] = self.get_valid_name(name)
+        finf['path'] = full_path
+        finf['fstat'] = fstat
         return finf
 
     def delete(self, name):
@@ -167,31 +348,66 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         """
         full_path = self.path(name)
         if os.path.exists(full_path):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                with caches['default'].lock('{}_{}'.format(full_path, 'writer')):
-                    os.remove(full_path)
-                    return True
+            with self._rwlock(full_path, 'w'):
+                os.remove(full_path)
+                return True
         return False
 
 
     def safe_read(self, name):
         """
-        Read the file in a threadsafe manner
+        Read the file in a threadsafe manner. Large files are returned
+        as a read only memory map so pages load as they are touched.
+        The caller owns a returned map and must close it, for example
+        with a with block, or the mapping stays open.
 
         :param name:  The name of the file
         :type name:  str
         :return:  The file contents or None if there is no content
-        :rtype: str
+        :rtype: bytes or mmap.mmap
         """
         full_path = self.path(name)
         content = None
         if self.exists(name):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                with open(full_path, 'r') as fd:
-                    content = fd.read()
+            with self._rwlock(full_path, 'r'):
+                with open(full_path, 'rb') as fd:
+                    fsize = os.fstat(fd.fileno()).st_size
+                    if fsize < MMAP_THRESHOLD:
+                        content = fd.read()
+                    else:
+                        content = mmap.mmap(fd.fileno(), fsize, access=mmap.ACCESS_READ)
+                        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                            content.madvise(mmap.MADV_SEQUENTIAL)
         return content
 
-    def safe_read_chunk(self, name, offset=0, length=1024):
+    def _read_chunk_unlocked(self, fd, offset, length, fsize, buf=None):
+        """
+        Read a chunk from an open descriptor. The caller holds the reader
+        lock and passes the size it already knows, so nothing is stat'ed here.
+
+        :param fd:  The open file descriptor
+        :type fd:  int
+        :param offset:  The offset in bytes to start reading from
+        :type offset:  int
+        :param length:  The number of bytes to read
+        :type length:  int
+        :param fsize:  The size of the file
+        :type fsize:  int
+        :param buf:  Optional buffer to read into, a view of it is returned
+        :type buf:  bytearray
+        :return:  The bytes and number of bytes read
+        :rtype: tuple
+        """
+        if offset >= fsize:
+            return (None, 0)
+        length = min(length, fsize - offset)
+        if buf is None:
+            byte_buffer = os.pread(fd, length, offset)
+            return (byte_buffer, len(byte_buffer))
+        l = os.preadv(fd, [memoryview(buf)[:length]], offset)
+        return (memoryview(buf)[:l], l)
+
+    def safe_read_chunk(self, name, offset=0, length=DEFAULT_CHUNK_SIZE, buf=None, fsize=None):
         """
         Safe read a chunk
         :param name:  The name of the file
@@ -200,47 +416,110 @@ class LocalFileStorage(FileSystemStorage, ResumableWebDav):
         :type offset:  int
         :param length:  The number of bytes to read
         :type length:  int
+        :param buf:  Optional buffer to read into, a view of it is returned
+        :type buf:  bytearray
+        :param fsize:  The size of the file when already known, skips the stat
+        :type fsize:  int
         :return:  The bytes and number of bytes read
         :rtype: tuple
         """
         full_path = self.path(name)
-        byte_buffer = None
-        l = 0
-        if self.exists(name):
-            with caches['default'].lock('{}_{}'.format(full_path, 'reader')):
-                fd = os.open(full_path, 'r')
+        with self._rwlock(full_path, 'r'):
+            try:
+                fd = os.open(full_path, os.O_RDONLY)
+            except FileNotFoundError:
+                return (None, 0)
+            try:
+                if fsize is None:
+                    fsize = os.fstat(fd).st_size
+                return self._read_chunk_unlocked(fd, offset, length, fsize, buf)
+            finally:
+                os.close(fd)
+
+    def download(self, name, max_buf_length, checksum=False, reuse_buffer=False):
+        """
+        Create an iterator for downloading from a file (lazy read).
+        This is useful for rtc. The reader lock is taken and the file
+        opened once for the whole download.
+
+        :param name:  The name of the file
+        :type name:  str
+        :param max_buf_length:  Maximum length of the buffer to read
+        :type max_buf_length:  int
+        :param checksum:  Also yield the file digest, set on the last chunk.
+                          An empty file yields one empty chunk carrying it
+        :type checksum:  boolean
+        :param reuse_buffer:  Read every chunk into one pooled buffer and yield
+                              views of it, each only valid until the next chunk
+        :type reuse_buffer:  boolean
+        :return:  next bytes and number of read bytes with the current offset
+        :rtype:  tuple
+        """
+        full_path = self.path(name)
+        if checksum and self.checksum_algorithm is None:
+            raise ValueError("A checksum needs a checksum_algorithm.")
+        hasher = _new_hasher(self.checksum_algorithm) if checksum else None
+        with self._rwlock(full_path, 'r'):
+            fd = os.open(full_path, os.O_RDONLY)
+            try:
+                fsize = os.fstat(fd).st_size
+                # Size chunks to the file, never above the caller's limit.
+                chunk_size = min(max_buf_length, _choose_chunk_size(fsize))
+                current_offset = 0
+                if fsize == 0 and hasher is not None:
+                    # No chunk is read from an empty file, so send its digest alone.
+                    yield (b'', 0, 0, hasher.hexdigest())
+                buf = _acquire_buffer(chunk_size) if reuse_buffer else None
                 try:
-                    fsize = os.path.getsize(full_path)
-                    if offset < fsize:
-                        rlength = fsize - offset
-                        l = length
-                        if rlength < length:
-                            l = rlength
-                        fd.lseek(offset)
-                        byte_buffer = fd.read(l)
+                    while current_offset < fsize:
+                        view, l = self._read_chunk_unlocked(fd, current_offset, chunk_size, fsize, buf)
+                        if l == 0:
+                            break
+                        current_offset += l
+                        if hasher is None:
+                            yield (view, l, current_offset)
+                        else:
+                            # Hash while the chunk is still hot in cache.
+                            hasher.update(view)
+                            digest = hasher.hexdigest() if current_offset >= fsize else None
+                            yield (view, l, current_offset, digest)
                 finally:
-                    fd.close()
-        return (byte_buffer, l)
+                    if buf is not None:
+                        _release_buffer(buf)
+            finally:
+                os.close(fd)
 
-    def download(self, name, max_buf_length):
+    def download_parallel(self, name, max_buf_length, workers=4):
         """
-        Create an iterator for downloading from a file (lazy read).
-        This is useful for rtc.
+        Create an iterator for downloading from a file with chunks read
+        concurrently. os.pread does not move the file position, so the
+        workers share one descriptor.
 
         :param name:  The name of the file
         :type name:  str
         :param max_buf_length:  Maximum length of the buffer to read
         :type max_buf_length:  int
+        :param workers:  The number of concurrent readers
+        :type workers:  int
         :return:  next bytes and number of read bytes with the current offset
         :rtype:  tuple
         """
         full_path = self.path(name)
-        fsize = os.path.getsize(full_path)
-        current_offset = 0
-        while current_offset < fsize:
-            buf, l = self.safe_read_chunk(name, current_offset, max_buf_length)
-            current_offset += l
-            yield (buf, l, current_offset)
+
+        def read_at(span):
+            offset, length = span
+            return self._read_chunk_unlocked(fd, offset, length, fsize)[0]
+
+        with self._rwlock(full_path, 'r'):
+            fd = os.open(full_path, os.O_RDONLY)
+            try:
+                fsize = os.fstat(fd).st_size
+                spans = ((offset, min(max_buf_length, fsize - offset))
+                         for offset in range(0, fsize, max_buf_length))
+                for (offset, l), buf in _iter_parallel(read_at, spans, workers):
+                    yield (buf, l, offset + l)
+            finally:
+                os.close(fd)
 
     def mkdirs(self, dirs):
         """
@@ -4,13 +4,246 @@ Abstract webdav object
 @auhtor aevans
 """
 
+import functools
+import hashlib
+import queue
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 from django.core.cache import cache, caches
 
-from django.conf import global_settings as settings
+from django.conf import settings
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# Number of bytes moved per read or write call on the streaming paths.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Seconds to wait between checks while a lock is held by the other side.
+RWLOCK_POLL_SECONDS = 0.01
+
+# Lifetime of cache locks when MAX_FILE_LOCK_SECONDS is not set.
+DEFAULT_LOCK_SECONDS = 300
+
+# Resolved paths kept per storage, and lock keys kept in total, before
+# the memos are cleared or evicted.
+PATH_CACHE_SIZE = 4096
+
+# Read buffers kept for reuse by downloads. Buffers above the size cap are
+# not pooled so idle memory stays under BUFFER_POOL_SIZE * MAX_POOLED_BUFFER.
+BUFFER_POOL_SIZE = 16
+MAX_POOLED_BUFFER = 16 << 20
+_BUFFER_POOL = queue.LifoQueue(maxsize=BUFFER_POOL_SIZE)
+
+# Digest kept with stored files. 'xxh3_64' is far cheaper when integrity
+# only guards against corruption and xxhash is installed, and None skips
+# hashing altogether.
+CHECKSUM_ALGORITHM = 'sha256'
+
+# Deletes a lock only while it still belongs to the releasing user.
+_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def _locked_keys(fpath):
+    """
+    Build the cache keys guarding a path
+
+    :param fpath:  The full file path
+    :type fpath:  str
+    :return:  The readers counter key and the writer lock key
+    :rtype:  tuple
+    """
+    return ('{}:readers'.format(fpath), '{}:w'.format(fpath))
+
+
+def _lock_seconds():
+    """
+    Get the lifetime of cache locks
+
+    :return:  MAX_FILE_LOCK_SECONDS or the default
+    :rtype:  int
+    """
+    return getattr(settings, 'MAX_FILE_LOCK_SECONDS', DEFAULT_LOCK_SECONDS)
+
+
+def _choose_chunk_size(fsize):
+    """
+    Pick a read size for a file, aiming for about 64 chunks per file
+    clamped to between 256KB and 16MB
+
+    :param fsize:  The size of the file
+    :type fsize:  int
+    :return:  The chunk size in bytes
+    :rtype:  int
+    """
+    return min(max(fsize // 64, 256 << 10), 16 << 20)
+
+
+def _new_hasher(algorithm):
+    """
+    Create an incremental hash object
+
+    :param algorithm:  A hashlib algorithm name, 'xxh3_64' or None
+    :type algorithm:  str
+    :return:  The hash object or None when no algorithm is set
+    :rtype:  object
+    """
+    if algorithm is None:
+        return None
+    if algorithm == 'xxh3_64':
+        if xxhash is None:
+            raise ImportError("xxhash is required for the xxh3_64 checksum.")
+        return xxhash.xxh3_64()
+    return hashlib.new(algorithm)
+
+
+def _acquire_buffer(length):
+    """
+    Take a read buffer of at least length bytes from the pool
+
+    :param length:  The minimum buffer size
+    :type length:  int
+    :return:  The buffer
+    :rtype:  bytearray
+    """
+    try:
+        buf = _BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buf = None
+    if buf is None or len(buf) < length:
+        buf = bytearray(max(length, DEFAULT_CHUNK_SIZE))
+    return buf
+
+
+def _release_buffer(buf):
+    """
+    Return a read buffer to the pool
+
+    :param buf:  The buffer from _acquire_buffer
+    :type buf:  bytearray
+    """
+    if len(buf) <= MAX_POOLED_BUFFER:
+        try:
+            _BUFFER_POOL.put_nowait(buf)
+        except queue.Full:
+            pass
+
+
+def _iter_parallel(func, spans, workers):
+    """
+    Apply a read function to (offset, length) spans on a thread pool
+
+    Results are yielded in span order. At most two reads per worker are
+    in flight so a slow consumer does not pull the whole file into memory.
+
+    :param func:  Function taking a span and returning the bytes read
+    :type func:  callable
+    :param spans:  The (offset, length) pairs to read
+    :type spans:  iterable
+    :param workers:  The number of reader threads
+    :type workers:  int
+    :return:  The span and the bytes read for it
+    :rtype:  tuple
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for span in spans:
+                pending.append((span, executor.submit(func, span)))
+                if len(pending) >= 2 * workers:
+                    span, future = pending.popleft()
+                    yield (span, future.result())
+            while pending:
+                span, future = pending.popleft()
+                yield (span, future.result())
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
 class ResumableWebDav(object):
 
+    checksum_algorithm = CHECKSUM_ALGORITHM
+
+    @contextmanager
+    def _rwlock(self, fpath, mode='r'):
+        """
+        Hold a read or write lock on a path
+
+        Writers take a single cache lock and wait for active readers to
+        drain. Readers only register in a counter while no writer holds
+        the lock, so any number of them may read at once. Both keys expire
+        after the lock lifetime, so an abandoned holder cannot block the
+        path forever.
+
+        :param fpath:  The full file path
+        :type fpath:  str
+        :param mode:  'r' to read or 'w' to write
+        :type mode:  str
+        :raises TimeoutError:  When a writer waits longer than the lock lifetime
+        """
+        backend = caches['default']
+        readers_key, writer_key = _locked_keys(fpath)
+        timeout = _lock_seconds()
+        if mode == 'w':
+            deadline = time.monotonic() + timeout
+            token = uuid.uuid4().hex
+            while not backend.add(writer_key, token, timeout):
+                if time.monotonic() > deadline:
+                    raise TimeoutError("Timed out waiting for the write lock on {}.".format(fpath))
+                time.sleep(RWLOCK_POLL_SECONDS)
+            try:
+                while backend.get(readers_key, 0) > 0:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Timed out waiting for readers of {}.".format(fpath))
+                    time.sleep(RWLOCK_POLL_SECONDS)
+                yield
+            finally:
+                self.unlock(writer_key, token)
+            return
+        while True:
+            try:
+                backend.incr(readers_key)
+            except ValueError:
+                backend.add(readers_key, 0, timeout)
+                backend.incr(readers_key)
+            # Keep the counter alive for as long as readers keep arriving.
+            backend.touch(readers_key, timeout)
+            if not backend.has_key(writer_key):
+                break
+            self._release_reader(readers_key)
+            time.sleep(RWLOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            self._release_reader(readers_key)
+
+    def _release_reader(self, readers_key):
+        """
+        Deregister a reader. A counter that already expired counts as no
+        readers.
+
+        :param readers_key:  The readers counter key
+        :type readers_key:  str
+        """
+        try:
+            caches['default'].decr(readers_key)
+        except ValueError:
+            pass
+
     def is_locked(self, fpath):
         """
         Check whether a path is locked
@@ -24,34 +257,58 @@ class ResumableWebDav(object):
 
     def lock(self, fpath, user):
         """
-        Lock a file
+        Lock a file. The lock is taken with an atomic add, so exactly one
+        user can hold it until it is released or expires.
+
         :param fpath:  The full file path
         :type fpath:  str
         :param user:  The user performing the locking
         :type user:  str
-        :return: Whether the resource was locked and the user
-        :rtype:  tuple
+        :return: Whether the lock was acquired
+        :rtype:  boolean
         """
-
-        if caches['default'].get(fpath):
-            cache.set(fpath, user, settings.MAX_FILE_LOCK_SECONDS)
-            return (True, user)
-        else:
-            user = cache.get(fpath)
-            return (False, user)
+        return caches['default'].add(fpath, user, _lock_seconds())
 
     def unlock(self, fpath, user):
         """
-        Lock a file
+        Unlock a file if it is held by the user
         :param fpath:  Path to the file
         :type fpath:  str
         :param user:  The user to check against
-        :type user:  The
+        :type user:  str
+        :return:  Whether the lock was released
+        :rtype:  boolean
+        """
+        backend = caches['default']
+        client = getattr(backend, 'client', None)
+        if hasattr(client, 'get_client'):
+            # django-redis, so compare and delete in one server side step.
+            release = client.get_client(write=True).register_script(_UNLOCK_SCRIPT)
+            return bool(release(keys=[client.make_key(fpath)], args=[client.encode(user)]))
+        if backend.get(fpath) == user:
+            backend.delete(fpath)
+            return True
+        return False
+
+    @contextmanager
+    def _user_lock(self, fpath, user):
         """
-        check_user = cache.get(fpath)
-        if check_user and check_user == user:
-            cache.delete(fpath)
-        return check_user
+        Hold the lock on a path for a user. A lock the user already holds
+        is used as is and left in place afterwards.
+
+        :param fpath:  The full file path
+        :type fpath:  str
+        :param user:  The user performing the operation
+        :type user:  str
+        :return:  Whether the user holds the lock
+        :rtype:  boolean
+        """
+        taken = self.lock(fpath, user)
+        try:
+            yield taken or caches['default'].get(fpath) == user
+        finally:
+            if taken:
+                self.unlock(fpath, user)
 
     def move(self, name, new_name):
         """
@@ -105,7 +362,7 @@ class ResumableWebDav(object):
         """
         pass
 
-    def safe_read_chunk(self, name, offset, length):
+    def safe_read_chunk(self, name, offset, length, buf=None, fsize=None):
         """
         Safely read a chunk
 
@@ -115,21 +372,46 @@ class ResumableWebDav(object):
         :type offset:  int
         :param length:  The length of the buffer to read
         :type length:  int
+        :param buf:  Optional buffer to read into instead of allocating
+        :type buf:  bytearray
+        :param fsize:  The size of the file when already known
+        :type fsize:  int
         :return:  The buffer read
         :rtype: bytes
         """
         pass
 
-    def download(self, name, max_buf_length):
+    def download(self, name, max_buf_length, checksum=False, reuse_buffer=False):
         """
         Safely iterate through a file in chunks. Useful for
-        WebRTC
+        WebRTC.
 
         :param name:  The name of the file
         :type name:  str
         :param max_buf_length:  Maximum buffer length
         :type max_buf_length:  int
+        :param checksum:  Also yield the file digest, set on the last chunk
+        :type checksum:  boolean
+        :param reuse_buffer:  Yield views of one pooled buffer, each only valid
+                              until the next chunk is requested
+        :type reuse_buffer:  boolean
         :return:  the next bytes, number of bytes read, current offset
         :rtype:  int
         """
         pass
+
+    def download_parallel(self, name, max_buf_length, workers=4):
+        """
+        Iterate through a file in chunks read concurrently. Chunks
+        are yielded in file order.
+
+        :param name:  The name of the file
+        :type name:  str
+        :param max_buf_length:  Maximum buffer length
+        :type max_buf_length:  int
+        :param workers:  The number of concurrent readers
+        :type workers:  int
+        :return:  the next bytes, number of bytes read, current offset
+        :rtype:  tuple
+        """
+        pass
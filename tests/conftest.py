@@ -0,0 +1,8 @@
+"""
+Shared pytest configuration for the storage tests.
+
+@author aevans
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
@@ -0,0 +1,17 @@
+"""
+Minimal Django settings for the storage tests.
+
+@author aevans
+"""
+
+SECRET_KEY = 'storage-tests'
+
+USE_TZ = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+MAX_FILE_LOCK_SECONDS = 60
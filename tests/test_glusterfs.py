@@ -0,0 +1,219 @@
+"""
+Tests for the GlusterFSStorage class. The gfapi volume is replaced by a
+stub that keeps files in a local directory, so no cluster is needed.
+
+@author aevans
+"""
+import hashlib
+import os
+import shutil
+import sys
+import types
+from urllib.parse import urljoin
+
+from django.core.files.base import ContentFile
+from django.utils.encoding import filepath_to_uri
+
+import pytest
+
+
+class StubFile(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        return os.write(self.fd, data)
+
+    def read(self, length=-1):
+        if length < 0:
+            length = os.fstat(self.fd).st_size
+        return os.read(self.fd, length)
+
+    def readinto(self, buf):
+        return os.readv(self.fd, [buf])
+
+    def lseek(self, offset, whence=os.SEEK_SET):
+        return os.lseek(self.fd, offset, whence)
+
+    def fstat(self):
+        return os.fstat(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StubVolume(object):
+    """
+    A gfapi.Volume keeping its files under root on the local disk
+    """
+
+    root = None
+    xattrs = {}
+
+    def __init__(self, host, volume, proto=None, port=None, log_file=None, log_level=None):
+        self.mounted = True
+
+    def _local(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def mount(self):
+        pass
+
+    def open(self, path, flags=os.O_RDONLY, mode=0o777):
+        return StubFile(os.open(self._local(path), flags, mode))
+
+    def fopen(self, path, mode='r'):
+        flags = {'r': os.O_RDONLY, 'a+': os.O_RDWR | os.O_APPEND | os.O_CREAT}[mode]
+        return StubFile(os.open(self._local(path), flags, 0o666))
+
+    def stat(self, path):
+        return os.stat(self._local(path))
+
+    def exists(self, path):
+        return os.path.exists(self._local(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self._local(path))
+
+    def getsize(self, path):
+        return os.path.getsize(self._local(path))
+
+    def makedirs(self, path, mode=0o777):
+        os.makedirs(self._local(path), mode)
+
+    def chmod(self, path, mode):
+        os.chmod(self._local(path), mode)
+
+    def remove(self, path):
+        os.remove(self._local(path))
+
+    def mknod(self, path, mode=0o644):
+        os.mknod(self._local(path), mode)
+
+    def copy2(self, src, dst):
+        shutil.copy2(self._local(src), self._local(dst))
+
+    def setxattr(self, path, key, value):
+        StubVolume.xattrs[(path, key)] = value
+
+    def listdir_with_stat(self, path):
+        local = self._local(path)
+        return [(entry, os.lstat(os.path.join(local, entry))) for entry in os.listdir(local)]
+
+
+gfapi = types.ModuleType('gluster.gfapi')
+gfapi.Volume = StubVolume
+gluster = types.ModuleType('gluster')
+gluster.gfapi = gfapi
+sys.modules['gluster'] = gluster
+sys.modules['gluster.gfapi'] = gfapi
+
+from storage import glusterfs_storage  # noqa: E402
+from storage.glusterfs_storage import GlusterFSConfig, GlusterFSStorage  # noqa: E402
+
+
+@pytest.fixture
+def volume_root(tmp_path):
+    StubVolume.root = str(tmp_path)
+    StubVolume.xattrs = {}
+    return tmp_path
+
+
+@pytest.fixture
+def gfs(volume_root):
+    config = GlusterFSConfig('localhost', 24007, 'test', mount_point=str(volume_root))
+    return GlusterFSStorage(config, option={'checksum_algorithm': 'sha256'},
+                            location='/', base_url='/media/')
+
+
+def test_download_uring(gfs, volume_root):
+    if glusterfs_storage.liburing is None:
+        pytest.skip('liburing is not installed')
+    data = os.urandom(300000)
+    (volume_root / 'test_uring.bin').write_bytes(data)
+    chunks = list(gfs.download_uring('test_uring.bin', 4096, depth=8))
+    assert(b''.join(buf for buf, l, offset in chunks) == data)
+    assert([offset for _, _, offset in chunks] == list(range(4096, len(data), 4096)) + [len(data)])
+    chunks = gfs.download_uring('test_uring.bin', 4096, depth=8, reuse_buffer=True)
+    assert(b''.join(bytes(buf) for buf, l, offset in chunks) == data)
+    (volume_root / 'test_uring_empty.bin').write_bytes(b'')
+    assert(list(gfs.download_uring('test_uring_empty.bin', 4096)) == [])
+
+
+def test_url(gfs):
+    for name in ('test_url.txt', 'a dir/b&c.txt', '/leading/slash.txt', 'win\\path.txt', 'café.txt'):
+        assert(gfs.url(name) == urljoin('/media/', filepath_to_uri(name).lstrip('/')))
+
+
+def test_get_dirs(gfs, volume_root):
+    (volume_root / 'listing' / 'sub').mkdir(parents=True)
+    (volume_root / 'listing' / 'entry.txt').write_bytes(b'entry')
+    os.symlink('entry.txt', str(volume_root / 'listing' / 'link'))
+    assert(gfs.get_dirs('/listing') == (['sub'], ['entry.txt']))
+    assert(gfs.listdir('/listing') == (['sub'], ['entry.txt']))
+
+
+@pytest.mark.parametrize('size', [0, 5000, 300000])
+def test_copy_to_volume(gfs, volume_root, tmp_path_factory, monkeypatch, size):
+    monkeypatch.setattr(glusterfs_storage, 'MIN_UPLOAD_PART_SIZE', 64 << 10)
+    data = os.urandom(size)
+    src = tmp_path_factory.mktemp('upload') / 'test_upload.bin'
+    src.write_bytes(data)
+    digest = gfs._copy_to_volume(str(src), '/test_copy.bin')
+    assert(digest == hashlib.sha256(data).hexdigest())
+    assert((volume_root / 'test_copy.bin').read_bytes() == data)
+    multipart = ('/test_copy.bin', 'trusted.glusterfs.stripe-count') in StubVolume.xattrs
+    assert(multipart is (size >= 128 << 10))
+    with pytest.raises(FileExistsError):
+        gfs._copy_to_volume(str(src), '/test_copy.bin')
+
+
+def test_download_parallel(gfs, volume_root):
+    data = os.urandom(300000)
+    (volume_root / 'test_parallel.bin').write_bytes(data)
+    chunks = list(gfs.download_parallel('test_parallel.bin', 1000, workers=3))
+    offsets = [offset for _, _, offset in chunks]
+    assert(offsets == sorted(offsets))
+    assert(b''.join(buf for buf, l, offset in chunks) == data)
+
+
+def test_download_checksum(gfs, volume_root):
+    data = os.urandom(300000)
+    (volume_root / 'test_digest.bin').write_bytes(data)
+    chunks = list(gfs.download('test_digest.bin', 4096, checksum=True))
+    assert(b''.join(buf for buf, _, _, _ in chunks) == data)
+    assert(chunks[-1][3] == hashlib.sha256(data).hexdigest())
+    (volume_root / 'test_digest_empty.bin').write_bytes(b'')
+    chunks = list(gfs.download('test_digest_empty.bin', 4096, checksum=True))
+    assert(chunks == [(b'', 0, 0, hashlib.sha256(b'').hexdigest())])
+
+
+def test_save_stores_checksum(gfs, volume_root):
+    assert(gfs._save('test_saved.txt', ContentFile(b'saved')) == (True, 'test_saved.txt'))
+    assert(StubVolume.xattrs[('/test_saved.txt', 'user.sha256')] == hashlib.sha256(b'saved').hexdigest())
+
+
+def test_save_without_user_xattrs(gfs, volume_root, monkeypatch):
+    def setxattr(self, path, key, value):
+        raise OSError(95, 'Operation not supported')
+
+    monkeypatch.setattr(StubVolume, 'setxattr', setxattr)
+    assert(gfs._save('test_noxattr.txt', ContentFile(b'saved')) == (True, 'test_noxattr.txt'))
+    assert((volume_root / 'test_noxattr.txt').read_bytes() == b'saved')
+
+
+def test_save_without_checksum(gfs, volume_root):
+    gfs.checksum_algorithm = None
+    assert(gfs._save('test_nohash.txt', ContentFile(b'saved')) == (True, 'test_nohash.txt'))
+    assert(StubVolume.xattrs == {})
+    with pytest.raises(ValueError):
+        list(gfs.download('test_nohash.txt', 4096, checksum=True))
@@ -1,26 +1,67 @@
 """
 Tests for the LocalFileStorage class.
 
+The tests share no state beyond the module fixtures and can be run in
+parallel with pytest-xdist (pytest -n auto) once requirements-test.txt
+is installed.
+
 @author aevans
 """
 import datetime
+import errno
+import hashlib
+import mmap
 import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
 
 from django.conf import settings
-from django.core.cache import cache, caches
+from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.test import override_settings
 
-from ..storage.localfs_storage import LocalFileStorage
+from storage import localfs_storage
+from storage.localfs_storage import LocalFileStorage
+from storage.webdav import _choose_chunk_size
 
 import pytest
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'filestorage.filestorage.settings')
-print(caches['default'])
+
+def _stat(p):
+    try:
+        return os.stat(p)
+    except FileNotFoundError:
+        return None
+
+
+def _can_write_lock(lock_file):
+    probe = ('import fasteners, sys\n'
+             'lock = fasteners.InterProcessReaderWriterLock(sys.argv[1])\n'
+             'sys.exit(0 if lock.acquire_write_lock(blocking=False) else 1)\n')
+    return subprocess.run([sys.executable, '-c', probe, lock_file]).returncode == 0
+
+
+@pytest.fixture(scope='module')
+def lfs(tmp_path_factory):
+    return LocalFileStorage(location=str(tmp_path_factory.mktemp('docs')))
+
+
+@pytest.fixture(scope='module')
+def saved_file(lfs):
+    lfs.save('test_app.txt', ContentFile('hello world!'))
+    return 'test_app.txt'
+
+
+@pytest.fixture(scope='module')
+def data_file(lfs):
+    data = os.urandom(300000)
+    lfs.save('test_data.bin', data)
+    return ('test_data.bin', data)
 
 
-@pytest.mark.order1
-def test_locking():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
+def test_locking(lfs):
     lfs.lock(lfs.path('test_app.txt'), 'me')
     assert(cache.get(lfs.path('test_app.txt')) == 'me')
     lfs.unlock(lfs.path('test_app.txt'), 'you')
@@ -29,111 +70,200 @@ def test_locking():
     assert(cache.get(lfs.path('test_app.txt')) is None)
 
 
-@pytest.mark.order2
-def test_save_file():
-    if os.path.exists('~/docs/') is False:
-        os.mkdir('~/docs/')
-    if os.path.exists('~/docs/test_app.txt'):
-        os.remove('~/docs/test_app.txt')
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    lfs.save('test_app.txt', ContentFile('hello world!'))
-    assert(os.path.exists('~/docs/test_app.txt'))
-    with open('~/docs/test_app.txt', 'r') as fp:
-        lines = fp.read()
-        assert('hello world!' in lines)
+def test_save_file(lfs):
+    lfs.save('test_save.txt', ContentFile('hello world!'))
+    st = os.stat(lfs.path('test_save.txt'))
+    assert(st.st_size > 0)
+    lines = Path(lfs.path('test_save.txt')).read_text()
+    assert('hello world!' in lines)
 
 
-@pytest.mark.order3
-def test_save_file_to_new_dir():
-    if os.path.exists('/home/aevans/docs/testdir/'):
-        os.remove('/home/aevans/docs/testdir/')
-    lfs = LocalFileStorage(location='/home/aevans/docs/testdir/')
-    lfs.save('test_app.txt', ContentFile('hello world!'))
-    assert (os.path.exists(lfs.path('test_app.txt')))
-    with open(lfs.path('test_app.txt'), 'r') as fp:
-        lines = fp.read()
-        assert ('hello world!' in lines)
+def test_save_file_to_new_dir(lfs):
+    lfs.save('testdir/test_app.txt', ContentFile('hello world!'))
+    st = os.stat(lfs.path('testdir/test_app.txt'))
+    assert (st.st_size > 0)
+    lines = Path(lfs.path('testdir/test_app.txt')).read_text()
+    assert ('hello world!' in lines)
 
 
-@pytest.mark.order4
-def test_get_accessed_time():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    dt = lfs.get_accessed_time('test_app.txt')
+def test_get_accessed_time(lfs, saved_file):
+    dt = lfs.get_accessed_time(saved_file)
     assert(type(dt) is datetime.datetime)
     assert(dt < datetime.datetime.now())
 
 
-@pytest.mark.order5
-def test_get_modified_time():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    dt = lfs.get_modified_time('test_app.txt')
+def test_get_modified_time(lfs, saved_file):
+    dt = lfs.get_modified_time(saved_file)
     assert (type(dt) is datetime.datetime)
     assert (dt < datetime.datetime.now())
 
 
-@pytest.mark.order6
-def test_get_created_time():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    dt = lfs.get_created_time('test_app.txt')
+def test_get_created_time(lfs, saved_file):
+    dt = lfs.get_created_time(saved_file)
     assert (type(dt) is datetime.datetime)
     assert (dt < datetime.datetime.now())
 
 
-@pytest.mark.order7
-def test_move_file():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    lfs.move('test_app.txt', 'test_app2.txt')
-    assert(os.path.exists('~/docs/test_app.txt') is False)
-    assert(os.path.exists('~/docs/test_app2.txt') is True)
-    os.rename('~/docs/test_app2.txt', '~/docs/test_app.txt')
-    assert(os.path.exists('~/docs/test_app.txt'))
+def test_move_file(lfs, saved_file):
+    lfs.move(saved_file, 'test_app2.txt')
+    assert(os.path.exists(lfs.path(saved_file)) is False)
+    assert(os.path.exists(lfs.path('test_app2.txt')) is True)
+    os.rename(lfs.path('test_app2.txt'), lfs.path(saved_file))
+    assert(os.path.exists(lfs.path(saved_file)))
 
 
-@pytest.mark.order8
-def test_append_to_file():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    lfs.append('test_app.txt', ' it is me!', 'me')
-    with open('/home/aevans/docs/test_app.txt', 'r') as fp:
-        lines = fp.read()
-        assert('it is me!' in lines)
-        assert('hello world' in lines)
+def test_append_to_file(lfs, saved_file):
+    lfs.append(saved_file, ' it is me!', 'me')
+    lines = Path(lfs.path(saved_file)).read_text()
+    assert('it is me!' in lines)
+    assert('hello world' in lines)
 
 
-@pytest.mark.order9
-def test_mkcollection():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
+def test_mkcollection(lfs):
     lfs.mkcollection('test_app3.txt', 'me')
     assert(os.path.exists(lfs.path('test_app3.txt')))
     os.remove(lfs.path('test_app3.txt'))
 
 
-@pytest.mark.order10
-def test_propfind():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
-    stat = lfs.propfind(lfs.path('test_app.txt'))
+def test_propfind(lfs, saved_file):
+    stat = lfs.propfind(lfs.path(saved_file))
     assert(stat.get('modified_time') is not None)
 
 
-@pytest.mark.order11
-def test_append_bytes():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
+def test_append_bytes(lfs):
     byteo = 'hello world'.encode('utf-8')
-    if lfs.exists('test_bytes.txt'):
-        lfs.delete('test_bytes.txt')
+    lpath = lfs.path('test_bytes.txt')
+    st = _stat(lpath)
+    if st:
+        os.unlink(lpath)
     lfs.append('test_bytes.txt', byteo, 'me')
-    lpath = lfs.path('text_bytes.txt')
-    assert (os.path.exists(lpath))
-    assert(os.path.getsize(lpath) > 0)
+    st = os.stat(lpath)
+    assert(st.st_size > 0)
 
 
-@pytest.mark.order12
-def test_save_bytes():
-    lfs = LocalFileStorage(location='/home/aevans/docs/')
+def test_save_bytes(lfs):
     byteo = 'hello world'.encode('utf-8')
-    if lfs.exists('test_bytes.txt'):
-        lfs.delete('test_bytes.txt')
-    print('SAVING')
+    lpath = lfs.path('test_bytes.txt')
+    st = _stat(lpath)
+    if st:
+        os.unlink(lpath)
     lfs.save('test_bytes.txt', byteo)
-    lpath = lfs.path('text_bytes.txt')
-    assert(os.path.exists(lpath))
-    assert(os.path.getsize(lpath) > 0)
+    st = os.stat(lpath)
+    assert(st.st_size > 0)
+
+
+def test_append_under_own_lock(lfs):
+    lpath = lfs.path('test_locked.txt')
+    lfs.lock(lpath, 'me')
+    assert(lfs.append('test_locked.txt', 'mine', 'me') is True)
+    assert(lfs.append('test_locked.txt', 'theirs', 'you') is False)
+    assert(cache.get(lpath) == 'me')
+    lfs.unlock(lpath, 'me')
+    assert(Path(lpath).read_text() == 'mine')
+
+
+def test_download_parallel(lfs, data_file):
+    name, data = data_file
+    chunks = list(lfs.download_parallel(name, 1000, workers=3))
+    offsets = [offset for _, _, offset in chunks]
+    assert(offsets == sorted(offsets))
+    assert(b''.join(buf for buf, l, offset in chunks) == data)
+
+
+def test_move_across_devices(lfs, monkeypatch):
+    lfs.save('test_exdev.txt', b'moved bytes')
+
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, 'rename', rename)
+    assert(lfs.move('test_exdev.txt', 'test_exdev2.txt') is True)
+    assert(_stat(lfs.path('test_exdev.txt')) is None)
+    assert(Path(lfs.path('test_exdev2.txt')).read_bytes() == b'moved bytes')
+
+
+def test_download(lfs, data_file):
+    name, data = data_file
+    chunks = list(lfs.download(name, 4096))
+    assert(b''.join(buf for buf, l, offset in chunks) == data)
+    assert(chunks[-1][2] == len(data))
+
+
+def test_download_checksum(lfs, data_file):
+    name, data = data_file
+    chunks = list(lfs.download(name, 4096, checksum=True))
+    assert(all(digest is None for _, _, _, digest in chunks[:-1]))
+    assert(chunks[-1][3] == hashlib.sha256(data).hexdigest())
+
+
+def test_download_checksum_empty(lfs):
+    lfs.save('test_empty.bin', b'')
+    chunks = list(lfs.download('test_empty.bin', 4096, checksum=True))
+    assert(chunks == [(b'', 0, 0, hashlib.sha256(b'').hexdigest())])
+
+
+def test_listdir(lfs):
+    lfs.mkdirs('listing/sub')
+    lfs.save('listing/entry.txt', b'entry')
+    assert(lfs.listdir('listing') == (['sub'], ['entry.txt']))
+
+
+def test_safe_read(lfs, data_file, monkeypatch):
+    name, data = data_file
+    content = lfs.safe_read(name)
+    assert(type(content) is bytes)
+    assert(content == data)
+    monkeypatch.setattr(localfs_storage, 'MMAP_THRESHOLD', 0)
+    with lfs.safe_read(name) as content:
+        assert(type(content) is mmap.mmap)
+        assert(content[:] == data)
+
+
+def test_propfind_fields(lfs, data_file):
+    name, data = data_file
+    stat = lfs.propfind(name)
+    assert(stat['fstat'].st_size == len(data))
+    assert(stat['path'] == lfs.path(name))
+    assert(type(stat['created_time']) is datetime.datetime)
+    assert(type(stat['accessed_time']) is datetime.datetime)
+
+
+def test_choose_chunk_size():
+    assert(_choose_chunk_size(0) == 256 << 10)
+    assert(_choose_chunk_size(64 << 20) == 1 << 20)
+    assert(_choose_chunk_size(1 << 40) == 16 << 20)
+
+
+def test_save_returns_name(lfs):
+    assert(lfs.save('test_named.txt', ContentFile('named')) == 'test_named.txt')
+    assert(Path(lfs.path('test_named.txt')).read_text() == 'named')
+    assert(lfs.save('test_named.bin', b'named') == 'test_named.bin')
+    renamed = lfs.save('test_named.bin', b'again')
+    assert(renamed != 'test_named.bin')
+    assert(Path(lfs.path(renamed)).read_bytes() == b'again')
+
+
+def test_file_lock_held_until_last_reader(lfs, tmp_path):
+    pytest.importorskip('fasteners')
+    fpath = lfs.path('test_stripe.txt')
+    lock_file = str(tmp_path / str(localfs_storage._lock_stripe(fpath)))
+    entered = [threading.Event(), threading.Event()]
+    leave = [threading.Event(), threading.Event()]
+
+    def reader(i):
+        with lfs._rwlock(fpath, 'r'):
+            entered[i].set()
+            leave[i].wait()
+
+    with override_settings(LOCAL_STORAGE_LOCKS='file', LOCAL_STORAGE_LOCK_DIR=str(tmp_path)):
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for event in entered:
+            assert(event.wait(5))
+        leave[0].set()
+        threads[0].join()
+        assert(_can_write_lock(lock_file) is False)
+        leave[1].set()
+        threads[1].join()
+        assert(_can_write_lock(lock_file) is True)